@@ -25,12 +25,21 @@ public struct KernelCommunicator {
 
   public let jupyterSession: JupyterSession
 
-  private var previousDisplayMessages: [JupyterDisplayMessage] = []
+  private var previousSerializedDisplayMessages = BytesReference([CChar]())
+
+  /// A byte that is nonzero once there are handlers to run after successful
+  /// execution. The kernel reads it directly from memory, so that it can skip
+  /// evaluating `triggerAfterSuccessfulExecution()` when there is nothing to
+  /// run. It is never deallocated, because the kernel keeps its address.
+  public let hasAfterSuccessfulExecutionHandlers: UnsafeMutablePointer<UInt8>
 
   init(jupyterSession: JupyterSession) {
     self.afterSuccessfulExecutionHandlers = []
     self.parentMessageHandlers = []
     self.jupyterSession = jupyterSession
+    self.hasAfterSuccessfulExecutionHandlers =
+        UnsafeMutablePointer<UInt8>.allocate(capacity: 1)
+    self.hasAfterSuccessfulExecutionHandlers.initialize(to: 0)
   }
 
   /// Register a handler to run after the kernel successfully executes a cell
@@ -39,6 +48,7 @@ public struct KernelCommunicator {
   public mutating func afterSuccessfulExecution(
       run handler: @escaping () -> [JupyterDisplayMessage]) {
     afterSuccessfulExecutionHandlers.append(handler)
+    hasAfterSuccessfulExecutionHandlers.pointee = 1
   }
 
   /// Register a handler to run when the parent message changes.
@@ -47,19 +57,38 @@ public struct KernelCommunicator {
   }
 
   /// The kernel calls this after successfully executing a cell of user code.
-  /// Returns an array of messages, where each message is returned as an array
-  /// of parts, where each part is returned as an address to the memory containing the part's
-  /// bytes and a count of the number of bytes.
-  public mutating func triggerAfterSuccessfulExecution() -> [[(address: UInt, count: Int)]] {
-    // Keep a reference to the messages, so that their `.unsafeBufferPointer`
-    // stays valid while the kernel is reading from them.
-    previousDisplayMessages = afterSuccessfulExecutionHandlers.flatMap { $0() }
-    return previousDisplayMessages.map { message in
-      return message.parts.map { part in
+  /// Returns the address of and the number of bytes in a buffer containing
+  /// all the messages, so that the kernel can read them with a single memory
+  /// read. The buffer contains, as little-endian UInt32s:
+  /// - the number of messages, then for each message:
+  ///   - the number of parts, then for each part:
+  ///     - the number of bytes in the part, followed by the bytes.
+  public mutating func triggerAfterSuccessfulExecution() -> (address: UInt, count: Int) {
+    let displayMessages = afterSuccessfulExecutionHandlers.flatMap { $0() }
+    var serialized: [CChar] = []
+    KernelCommunicator.append(displayMessages.count, to: &serialized)
+    for message in displayMessages {
+      KernelCommunicator.append(message.parts.count, to: &serialized)
+      for part in message.parts {
         let b = part.unsafeBufferPointer
-        return (address: UInt(bitPattern: b.baseAddress), count: b.count)
+        KernelCommunicator.append(b.count, to: &serialized)
+        serialized.append(contentsOf: b)
       }
     }
+
+    // Keep a reference to the buffer, so that its `.unsafeBufferPointer`
+    // stays valid while the kernel is reading from it.
+    previousSerializedDisplayMessages = BytesReference(serialized)
+    let b = previousSerializedDisplayMessages.unsafeBufferPointer
+    return (address: UInt(bitPattern: b.baseAddress), count: b.count)
+  }
+
+  /// Appends `value` to `bytes` as a little-endian UInt32.
+  private static func append(_ value: Int, to bytes: inout [CChar]) {
+    var littleEndianValue = UInt32(value).littleEndian
+    withUnsafeBytes(of: &littleEndianValue) { valueBytes in
+      bytes.append(contentsOf: valueBytes.map { CChar(bitPattern: $0) })
+    }
   }
 
   /// The kernel calls this when the parent message changes.
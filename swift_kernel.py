@@ -14,30 +14,86 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import glob
+import bisect
+import codecs
 import json
 import lldb
 import os
 import stat
 import re
+import select
 import shlex
-import shutil
 import signal
 import string
+import struct
 import subprocess
 import sys
-import tempfile
-import textwrap
 import time
 import threading
-import sqlite3
-import json
 
 from ipykernel.kernelbase import Kernel
 from jupyter_client.jsonutil import squash_dates
 from tornado import ioloop
 
 
+# Directives that the kernel handles before executing code.
+_RE_INCLUDE = re.compile(r'^\s*%include (.*)$')
+_RE_INCLUDE_NAME = re.compile(r'^\s*"([^"]+)"\s*$')
+_RE_DISABLE_COMPLETION = re.compile(r'^\s*%disableCompletion\s*$')
+_RE_ENABLE_COMPLETION = re.compile(r'^\s*%enableCompletion\s*$')
+
+# The directives that `_process_installs` handles, and their arguments. This
+# is matched against whole cells, so the leading whitespace must not include
+# newlines.
+_RE_INSTALL_DIRECTIVE = re.compile(
+        r'^[^\S\n]*%(install-location|install-swiftpm-flags|'
+        r'install-extra-include-command|install|system) (.*)$', re.MULTILINE)
+
+_RE_MODULEMAP_HEADER = re.compile(r'header\s+"(.*?)"')
+_RE_MODULEMAP_MODULE = re.compile(r'module\s+([^\s]+)\s.*{')
+
+# Matches "%install" specs of packages whose contents can change while the spec
+# stays the same: local packages, and packages that track a branch or revision.
+# This errs on the side of matching, e.g. URLs that contain "path".
+_RE_UNPINNED_PACKAGE = re.compile(r'\b(?:path|branch|revision)\b')
+
+# Matches code that consists only of whitespace and line comments. A comment
+# may only follow the leading whitespace of its line, and every repetition
+# consumes a whole line, so matching takes linear time even on lines full of
+# slashes.
+_RE_BLANK_CODE = re.compile(
+        r'(?:[^\S\n]*(?://[^\n]*)?\n)*[^\S\n]*(?://[^\n]*)?\Z')
+
+# Environment variables that are not passed on to the Swift process.
+_REPL_ENV_BLACKLIST = frozenset(('PYTHONPATH', 'REPL_SWIFT_PATH'))
+
+# The integers in the display message buffer that KernelCommunicator sends us.
+_UINT32 = struct.Struct('<I')
+
+# Escapes that turn text into the contents of a Swift string literal. Swift
+# spells arbitrary escapes "\u{X}" rather than JSON's "\uXXXX", so `json.dumps`
+# only produces valid Swift literals for printable ASCII.
+_SWIFT_STRING_ESCAPES = str.maketrans({
+        **{chr(c): '\\u{%x}' % c for c in [*range(0x20), 0x7f]},
+        '\\': '\\\\', '"': '\\"', '\n': '\\n', '\r': '\\r', '\t': '\\t'})
+
+
+def _swift_str_literal(s):
+    """Returns a Swift string literal with the value `s`."""
+    return '"%s"' % s.translate(_SWIFT_STRING_ESCAPES)
+
+
+# Swift code templates that the kernel executes. Each takes a single Swift
+# string literal argument.
+_DLOPEN_TEMPLATE = (
+    'import func Glibc.dlopen\n'
+    'import var Glibc.RTLD_NOW\n'
+    'dlopen(%s, RTLD_NOW)\n')
+_SET_PARENT_MESSAGE_TEMPLATE = (
+    'JupyterKernel.communicator.updateParentMessage(\n'
+    '    to: KernelCommunicator.ParentMessage(json: %s))\n')
+
+
 class ExecutionResult:
     """Base class for the result of executing code."""
     pass
@@ -77,6 +133,10 @@ class SuccessWithValue(ExecutionResultSuccess):
             repr(self.result), repr(self.result.description))
 
 
+# `SuccessWithoutValue` has no state, so one instance can be shared.
+_SUCCESS_WITHOUT_VALUE = SuccessWithoutValue()
+
+
 class PreprocessorError(ExecutionResultError):
     """There was an error preprocessing the code."""
     def __init__(self, exception):
@@ -112,7 +172,14 @@ class SwiftError(ExecutionResultError):
 
 class SIGINTHandler(threading.Thread):
     """Interrupts currently-executing code whenever the process receives a
-       SIGINT."""
+       SIGINT.
+
+       SIGINT is blocked in every thread, and this thread receives it
+       synchronously with `sigwait`, so `SendAsyncInterrupt` runs in ordinary
+       thread context rather than inside a signal handler. A Python-level
+       `signal.signal` handler would not work here: Python runs those on the
+       main thread between bytecodes, and the main thread is stuck inside
+       `EvaluateExpression` for exactly as long as we want to interrupt it."""
 
     daemon = True
 
@@ -130,19 +197,59 @@ class SIGINTHandler(threading.Thread):
 
 
 class StdoutHandler(threading.Thread):
-    """Collects stdout from the Swift process and sends it to the client."""
+    """Collects stdout from the Swift process and sends it to the client.
+
+    One handler runs for the lifetime of the kernel. It collects stdout between
+    calls to `start_cell` and `stop_cell`, and sleeps otherwise."""
 
     daemon = True
 
+    # Bounds, in seconds, on how long to wait between checks for stdout while
+    # a cell runs. The interval drops to the minimum whenever there is output,
+    # so that it appears promptly, and backs off while the process is quiet.
+    MIN_POLL_INTERVAL = 0.01
+    MAX_POLL_INTERVAL = 0.1
+
+    # Stdout is held back until this many characters have accumulated or the
+    # oldest of them has waited this many seconds, so that chatty output is
+    # sent as a few large stream messages rather than many small ones.
+    MAX_PENDING_SIZE = 1 << 16
+    MAX_PENDING_DELAY = 0.05
+
     def __init__(self, kernel):
         super(StdoutHandler, self).__init__()
         self.kernel = kernel
+        self.cell_started = threading.Event()
         self.stop_event = threading.Event()
+        self.cell_done = threading.Event()
+        self.cell_done.set()
         self.had_stdout = False
+        self._pending_stdout = []
+        self._pending_stdout_size = 0
+        self._pending_stdout_since = None
+        self._stdout_decoder = None
+
+    def start_cell(self):
+        """Starts collecting stdout for a cell."""
+        self.had_stdout = False
+        self._pending_stdout = []
+        self._pending_stdout_size = 0
+        self._stdout_decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self.stop_event.clear()
+        self.cell_done.clear()
+        self.cell_started.set()
+
+    def stop_cell(self):
+        """Stops collecting stdout for a cell, after sending all remaining
+        stdout to the client."""
+        self.stop_event.set()
+        self.cell_done.wait()
 
     def _get_stdout(self):
+        # Large enough that even chatty output (e.g. training logs) takes only
+        # a few calls into LLDB to collect.
+        BUFFER_SIZE = 1 << 16
         while True:
-            BUFFER_SIZE = 1000
             stdout_buffer = self.kernel.process.GetSTDOUT(BUFFER_SIZE)
             if len(stdout_buffer) == 0:
                 break
@@ -152,35 +259,77 @@ class StdoutHandler(threading.Thread):
     # clearing the whole display with a 'clear_output' message to the jupyter
     # client.
     def _send_stdout(self, stdout):
-        clear_sequence = '\033[2J'
-        clear_sequence_index = stdout.find(clear_sequence)
-        if clear_sequence_index != -1:
-            self._send_stdout(stdout[:clear_sequence_index])
-            self.kernel.send_response(
-                self.kernel.iopub_socket, 'clear_output', {'wait': False})
-            self._send_stdout(
-                stdout[clear_sequence_index + len(clear_sequence):])
+        parts = stdout.split('\033[2J')
+        for index, part in enumerate(parts):
+            if index > 0:
+                self.kernel.send_response(
+                    self.kernel.iopub_socket, 'clear_output', {'wait': False})
+            if part:
+                self.kernel.send_response(self.kernel.iopub_socket, 'stream', {
+                    'name': 'stdout',
+                    'text': part
+                })
+
+    def _enqueue_stdout(self, stdout):
+        if len(self._pending_stdout) == 0:
+            self._pending_stdout_since = time.monotonic()
+        self._pending_stdout.append(stdout)
+        self._pending_stdout_size += len(stdout)
+
+    def _flush_stdout(self):
+        if len(self._pending_stdout) == 0:
+            return
+        stdout = ''.join(self._pending_stdout)
+        self._pending_stdout = []
+        self._pending_stdout_size = 0
+        self._send_stdout(stdout)
+
+    def _get_and_send_stdout(self, flush=False):
+        """Collects stdout and sends it, or holds it back to send along with
+        later stdout. Returns whether there was any new stdout."""
+        stdout_buffers = list(self._get_stdout())
+        if len(stdout_buffers) > 0 and isinstance(stdout_buffers[0], bytes):
+            # Some LLDB bindings return raw bytes. Decode them once per poll,
+            # after joining, with a decoder that carries a character split
+            # across polls over to the next one.
+            stdout = self._stdout_decoder.decode(b''.join(stdout_buffers),
+                                                 final=flush)
         else:
-            self.kernel.send_response(self.kernel.iopub_socket, 'stream', {
-                'name': 'stdout',
-                'text': stdout
-            })
-
-    def _get_and_send_stdout(self):
-        stdout = ''.join([buf for buf in self._get_stdout()])
+            stdout = ''.join(stdout_buffers)
         if len(stdout) > 0:
             self.had_stdout = True
-            self._send_stdout(stdout)
+            self._enqueue_stdout(stdout)
+
+        # Send display clears right away, so that animations which redraw by
+        # clearing the display keep their frame rate.
+        if flush or \
+                self._pending_stdout_size >= self.MAX_PENDING_SIZE or \
+                '\033[2J' in stdout or \
+                (len(self._pending_stdout) > 0 and
+                 time.monotonic() - self._pending_stdout_since >=
+                         self.MAX_PENDING_DELAY):
+            self._flush_stdout()
+        return len(stdout) > 0
 
     def run(self):
-        try:
-            while True:
-                if self.stop_event.wait(0.1):
-                    break
-                self._get_and_send_stdout()
-            self._get_and_send_stdout()
-        except Exception as e:
-            self.kernel.log.error('Exception in StdoutHandler: %s' % str(e))
+        while True:
+            self.cell_started.wait()
+            self.cell_started.clear()
+            try:
+                poll_interval = self.MIN_POLL_INTERVAL
+                while True:
+                    if self.stop_event.wait(poll_interval):
+                        break
+                    if self._get_and_send_stdout():
+                        poll_interval = self.MIN_POLL_INTERVAL
+                    else:
+                        poll_interval = min(2 * poll_interval,
+                                            self.MAX_POLL_INTERVAL)
+                self._get_and_send_stdout(flush=True)
+            except Exception as e:
+                self.kernel.log.error('Exception in StdoutHandler: %s' % str(e))
+            finally:
+                self.cell_done.set()
 
 
 class SwiftKernel(Kernel):
@@ -198,14 +347,48 @@ class SwiftKernel(Kernel):
     def __init__(self, **kwargs):
         super(SwiftKernel, self).__init__(**kwargs)
 
+        # Block SIGINT before the kernel starts any threads of its own, so that
+        # they all inherit the mask and `sigwait` in the `SIGINTHandler` thread
+        # is the only way that SIGINT gets delivered. This is normally already
+        # done in `__main__`, but not when the kernel class is launched some
+        # other way.
+        if hasattr(signal, 'pthread_sigmask'): # Not supported in Windows
+            signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGINT])
+
         # We don't initialize Swift yet, so that the user has a chance to
         # "%install" packages before Swift starts. (See doc comment in
         # `_init_swift`).
 
+        # Whether `_init_swift` has created the debugger. Packages can only be
+        # installed before that.
+        self._debugger_started = False
+
+        # The directory that installed modules are copied to, if any packages
+        # have been installed.
+        self.swift_module_search_path = None
+
         # Whether to do code completion. Since the debugger is not yet
         # initialized, we can't do code completion yet.
         self.completion_enabled = False
 
+        # The directory containing this script, and the working directory as of
+        # the start of the current cell. Resolving these takes syscalls, so
+        # they are computed once rather than by every directive that uses them.
+        self._script_dir = os.path.dirname(os.path.realpath(sys.argv[0]))
+        self._cwd = os.getcwd()
+        self._cwd_subst = {'cwd': self._cwd}
+
+        # The file name that `#sourceLocation` directives use for the current
+        # cell, and the directive that `_execute` prepends to code. Updated at
+        # the start of every `do_execute`.
+        self._update_cell_file_name()
+
+        # The thread that forwards stdout while cells run. It only waits for
+        # the first cell until then, so it can start before Swift does, and
+        # every cell can rely on it even if initializing Swift failed.
+        self.stdout_handler = StdoutHandler(self)
+        self.stdout_handler.start()
+
     def _init_swift(self):
         """Initializes Swift so that it's ready to start executing user code.
 
@@ -225,11 +408,26 @@ class SwiftKernel(Kernel):
 
     def _init_repl_process(self):
         self.debugger = lldb.SBDebugger.Create()
+        self._debugger_started = True
         if not self.debugger:
             raise Exception('Could not start debugger')
         self.debugger.SetAsync(False)
 
-        if hasattr(self, 'swift_module_search_path'):
+        # By default, memory that expression evaluation writes invalidates
+        # LLDB's cached values, and the kernel evaluates several expressions
+        # per cell. The trade-off is that "$R" convenience variables stop
+        # reflecting later writes to the process. Older LLDBs don't have this
+        # setting, so check whether it was accepted rather than letting the
+        # command print an error.
+        setting_result = lldb.SBCommandReturnObject()
+        self.debugger.GetCommandInterpreter().HandleCommand(
+                'settings set target.process.track-memory-cache-changes false',
+                setting_result)
+        if not setting_result.Succeeded():
+            self.log.debug('Could not disable memory cache change tracking: '
+                           '%s' % setting_result.GetError())
+
+        if self.swift_module_search_path is not None:
             self.debugger.HandleCommand("settings append target.swift-module-search-paths " + self.swift_module_search_path)
 
 
@@ -249,17 +447,11 @@ class SwiftKernel(Kernel):
         if not self.main_bp:
             raise Exception('Could not set breakpoint')
 
-        repl_env = []
-        script_dir = os.path.dirname(os.path.realpath(sys.argv[0]))
-        repl_env.append('PYTHONPATH=%s' % script_dir)
-        env_var_blacklist = [
-            'PYTHONPATH',
-            'REPL_SWIFT_PATH'
+        repl_env = ['PYTHONPATH=%s' % self._script_dir] + [
+            '%s=%s' % (key, value)
+            for key, value in sorted(os.environ.items())
+            if key not in _REPL_ENV_BLACKLIST
         ]
-        for key in os.environ:
-            if key in env_var_blacklist:
-                continue
-            repl_env.append('%s=%s' % (key, os.environ[key]))
 
         # Turn off "disable ASLR" because it uses the "personality" syscall in
         # a way that is forbidden by the default Docker security policy.
@@ -270,7 +462,7 @@ class SwiftKernel(Kernel):
 
         self.process = self.target.LaunchSimple(None,
                                                 repl_env,
-                                                os.getcwd())
+                                                self._cwd)
         if not self.process:
             raise Exception('Could not launch process')
 
@@ -279,8 +471,12 @@ class SwiftKernel(Kernel):
             'swift')
         self.expr_opts.SetLanguage(self.swift_language)
         self.expr_opts.SetREPLMode(True)
+        # Keep the stack of a crashed expression and its debug info around, so
+        # that `_get_pretty_main_thread_stack_trace` can show where it failed.
         self.expr_opts.SetUnwindOnError(False)
         self.expr_opts.SetGenerateDebugInfo(True)
+        # Don't resolve dynamic types of results, which we never display.
+        self.expr_opts.SetFetchDynamicValue(lldb.eNoDynamicValues)
 
         # Sets an infinite timeout so that users can run aribtrarily long
         # computations.
@@ -301,25 +497,53 @@ class SwiftKernel(Kernel):
                     jupyterSession: KernelCommunicator.JupyterSession(
                         id: %s, key: %s, username: %s))
             }
-        """ % (json.dumps(self.session.session), json.dumps(session_key),
-               json.dumps(self.session.username))
+        """ % (_swift_str_literal(self.session.session),
+               _swift_str_literal(session_key),
+               _swift_str_literal(self.session.username))
         result = self._preprocess_and_execute(decl_code)
         if isinstance(result, ExecutionResultError):
             raise Exception('Error declaring JupyterKernel: %s' % result)
 
+        result = self._execute_internal(
+                'UInt(bitPattern: JupyterKernel.communicator'
+                '.hasAfterSuccessfulExecutionHandlers)')
+        if not isinstance(result, SuccessWithValue):
+            raise Exception('Expected value from '
+                            'hasAfterSuccessfulExecutionHandlers, but got: %s' %
+                            result)
+        get_address_error = lldb.SBError()
+        self._has_handlers_address = result.result.GetData().GetAddress(
+                get_address_error, 0)
+        if get_address_error.Fail():
+            raise Exception('getting address: %s' % str(get_address_error))
+
     def _init_int_bitwidth(self):
-        result = self._execute('Int.bitWidth')
+        result = self._execute_internal('Int.bitWidth')
         if not isinstance(result, SuccessWithValue):
             raise Exception('Expected value from Int.bitWidth, but got: %s' %
                             result)
         self._int_bitwidth = int(result.result.GetData().GetSignedInt32(lldb.SBError(), 0))
 
+        # The SBData method that reads a Swift `Int`.
+        if self._int_bitwidth == 32:
+            self._read_int = lldb.SBData.GetSignedInt32
+        elif self._int_bitwidth == 64:
+            self._read_int = lldb.SBData.GetSignedInt64
+        else:
+            raise Exception('Unsupported integer bitwidth %d' %
+                            self._int_bitwidth)
+
     def _init_sigint_handler(self):
         self.sigint_handler = SIGINTHandler(self)
         self.sigint_handler.start()
 
+    def _update_cell_file_name(self):
+        self._cell_file_name = '<Cell %d>' % self.execution_count
+        self._location_directive = '#sourceLocation(file: "%s", line: 1)\n' % (
+                self._cell_file_name)
+
     def _file_name_for_source_location(self):
-        return '<Cell %d>' % self.execution_count
+        return self._cell_file_name
 
     def _preprocess_and_execute(self, code):
         try:
@@ -330,10 +554,13 @@ class SwiftKernel(Kernel):
         return self._execute(preprocessed)
 
     def _preprocess(self, code):
-        lines = code.split('\n')
-        preprocessed_lines = [
-                self._preprocess_line(i, line) for i, line in enumerate(lines)]
-        return '\n'.join(preprocessed_lines)
+        # Code without any directives passes through unchanged, so there is no
+        # need to split it into lines and join it back together.
+        if '%' not in code:
+            return code
+        return '\n'.join(
+                self._preprocess_line(i, line)
+                for i, line in enumerate(code.split('\n')))
 
     def _handle_disable_completion(self):
         self.completion_enabled = False
@@ -363,16 +590,21 @@ class SwiftKernel(Kernel):
         Does not process "%install" directives, because those need to be
         handled before everything else."""
 
-        include_match = re.match(r'^\s*%include (.*)$', line)
+        # Every directive starts with "%", so most lines (plain Swift code) can
+        # skip the regex matching below.
+        if not line.lstrip().startswith('%'):
+            return line
+
+        include_match = _RE_INCLUDE.match(line)
         if include_match is not None:
             return self._read_include(line_index, include_match.group(1))
 
-        disable_completion_match = re.match(r'^\s*%disableCompletion\s*$', line)
+        disable_completion_match = _RE_DISABLE_COMPLETION.match(line)
         if disable_completion_match is not None:
             self._handle_disable_completion()
             return ''
 
-        enable_completion_match = re.match(r'^\s*%enableCompletion\s*$', line)
+        enable_completion_match = _RE_ENABLE_COMPLETION.match(line)
         if enable_completion_match is not None:
             self._handle_enable_completion()
             return ''
@@ -380,7 +612,7 @@ class SwiftKernel(Kernel):
         return line
 
     def _read_include(self, line_index, rest_of_line):
-        name_match = re.match(r'^\s*"([^"]+)"\s*$', rest_of_line)
+        name_match = _RE_INCLUDE_NAME.match(rest_of_line)
         if name_match is None:
             raise PreprocessorException(
                     'Line %d: %%include must be followed by a name in quotes' % (
@@ -388,17 +620,20 @@ class SwiftKernel(Kernel):
         name = name_match.group(1)
 
         include_paths = [
-            os.path.dirname(os.path.realpath(sys.argv[0])),
-            os.path.realpath("."),
+            self._script_dir,
+            self._cwd,
         ]
 
+        # Later include paths take precedence over earlier ones, so search them
+        # in reverse and stop at the first file that can be read.
         code = None
-        for include_path in include_paths:
+        for include_path in reversed(include_paths):
             try:
                 with open(os.path.join(include_path, name), 'r') as f:
                     code = f.read()
+                break
             except IOError:
-                continue
+                pass
 
         if code is None:
             raise PreprocessorException(
@@ -416,40 +651,54 @@ class SwiftKernel(Kernel):
     def _process_installs(self, code):
         """Handles all "%install" directives, and returns `code` with all
         "%install" directives removed."""
-        processed_lines = []
+        # Directives may be indented, so only the absence of any "%" rules them
+        # out. Without directives there is nothing to install.
+        if '%' not in code:
+            return code
+
+        # Rather than splitting the code into lines, find the directives in it
+        # and copy the code between them.
+        processed_code = []
+        position = 0
+        index = 0
         all_packages = []
         all_swiftpm_flags = []
         extra_include_commands = []
         user_install_location = None
-        for index, line in enumerate(code.split('\n')):
-            line = self._process_system_command_line(line)
-            line, install_location = self._process_install_location_line(line)
-            line, swiftpm_flags = self._process_install_swiftpm_flags_line(
-                    line)
-            all_swiftpm_flags += swiftpm_flags
-            line, packages = self._process_install_line(index, line)
-            line, extra_include_command = \
-                self._process_extra_include_command_line(line)
-            if extra_include_command:
-                extra_include_commands.append(extra_include_command)
-            processed_lines.append(line)
-            all_packages += packages
-            if install_location: user_install_location = install_location
+        for directive_match in _RE_INSTALL_DIRECTIVE.finditer(code):
+            index += code.count('\n', position, directive_match.start())
+            processed_code.append(code[position:directive_match.start()])
+            position = directive_match.end()
+
+            directive, rest_of_line = directive_match.groups()
+            if directive == 'system':
+                self._process_system_command(rest_of_line)
+            elif directive == 'install-location':
+                install_location = self._process_install_location(
+                        index, rest_of_line)
+                if install_location: user_install_location = install_location
+            elif directive == 'install-swiftpm-flags':
+                all_swiftpm_flags += shlex.split(rest_of_line)
+            elif directive == 'install':
+                all_packages.append(self._process_install(index, rest_of_line))
+            elif directive == 'install-extra-include-command':
+                if rest_of_line:
+                    extra_include_commands.append(rest_of_line)
+        processed_code.append(code[position:])
 
         self._install_packages(all_packages, all_swiftpm_flags,
                                extra_include_commands,
                                user_install_location)
-        return '\n'.join(processed_lines)
-
-    def _process_install_location_line(self, line):
-        install_location_match = re.match(
-                r'^\s*%install-location (.*)$', line)
-        if install_location_match is None:
-            return line, None
-
-        install_location = install_location_match.group(1)
+        return ''.join(processed_code)
+
+    def _substitute_cwd(self, line_index, template):
+        """Substitutes "$cwd" in a directive argument."""
+        # Most arguments contain no substitutions, so don't build a Template
+        # for them.
+        if '$' not in template:
+            return template
         try:
-            install_location = string.Template(install_location).substitute({"cwd": os.getcwd()})
+            return string.Template(template).substitute(self._cwd_subst)
         except KeyError as e:
             raise PackageInstallException(
                     'Line %d: Invalid template argument %s' % (line_index + 1,
@@ -458,93 +707,172 @@ class SwiftKernel(Kernel):
             raise PackageInstallException(
                     'Line %d: %s' % (line_index + 1, str(e)))
 
-        return '', install_location
-
-    def _process_extra_include_command_line(self, line):
-        extra_include_command_match = re.match(
-                r'^\s*%install-extra-include-command (.*)$', line)
-        if extra_include_command_match is None:
-            return line, None
-
-        extra_include_command = extra_include_command_match.group(1)
-
-        return '', extra_include_command
-
-    def _process_install_swiftpm_flags_line(self, line):
-        install_swiftpm_flags_match = re.match(
-                r'^\s*%install-swiftpm-flags (.*)$', line)
-        if install_swiftpm_flags_match is None:
-            return line, []
-        flags = shlex.split(install_swiftpm_flags_match.group(1))
-        return '', flags
+    def _process_install_location(self, line_index, rest_of_line):
+        return self._substitute_cwd(line_index, rest_of_line)
 
-    def _process_install_line(self, line_index, line):
-        install_match = re.match(r'^\s*%install (.*)$', line)
-        if install_match is None:
-            return line, []
-
-        parsed = shlex.split(install_match.group(1))
+    def _process_install(self, line_index, rest_of_line):
+        parsed = shlex.split(rest_of_line)
         if len(parsed) < 2:
             raise PackageInstallException(
                     'Line %d: %%install usage: SPEC PRODUCT [PRODUCT ...]' % (
                             line_index + 1))
-        try:
-            spec = string.Template(parsed[0]).substitute({"cwd": os.getcwd()})
-        except KeyError as e:
-            raise PackageInstallException(
-                    'Line %d: Invalid template argument %s' % (line_index + 1,
-                                                               str(e)))
-        except ValueError as e:
-            raise PackageInstallException(
-                    'Line %d: %s' % (line_index + 1, str(e)))
-
-        return '', [{
-            'spec': spec,
+        return {
+            'spec': self._substitute_cwd(line_index, parsed[0]),
             'products': parsed[1:],
-        }]
-
-    def _process_system_command_line(self, line):                  
-        system_match = re.match(r'^\s*%system (.*)$', line)
-        if system_match is None:
-            return line
+        }
 
-        if hasattr(self, 'debugger'):
+    def _process_system_command(self, rest_of_line):
+        if self._debugger_started:
             raise PackageInstallException(
                     'System commands can only run in the first cell.')
 
-        rest_of_line = system_match.group(1)
-        process = subprocess.Popen(rest_of_line,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.STDOUT,
-                            shell=True)
-        process.wait()
-        command_result = process.stdout.read().decode('utf-8')
+        # `run` reads the output while the command runs, so a command with a lot
+        # of output can't deadlock on a full pipe.
+        result = subprocess.run(rest_of_line,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                shell=True,
+                                encoding='utf-8',
+                                errors='replace')
         self.send_response(self.iopub_socket, 'stream', {
             'name': 'stdout',
-            'text': '%s' % command_result
+            'text': result.stdout
         })
-        return ''
 
-    def _link_extra_includes(self, swift_module_search_path, include_dir):
-        for include_file in os.listdir(include_dir):
-            link_name = os.path.join(swift_module_search_path, include_file)
-            target = os.path.join(include_dir, include_file)
-            try:
-                if stat.S_ISLNK(os.lstat(link_name).st_mode):
-                    os.unlink(link_name)
-            except FileNotFoundError as e:
-                pass
-            except Error as e:
-                raise PackageInstallException(
-                        'Failed to stat scratchwork base path: %s' % str(e))
-            os.symlink(target, link_name)
+    def _link_extra_include(self, swift_module_search_path, entry):
+        link_name = os.path.join(swift_module_search_path, entry.name)
+        # Links usually do not exist yet, so only check for a stale link when
+        # creating the new one fails.
+        try:
+            os.symlink(entry.path, link_name)
+        except FileExistsError:
+            if not os.path.islink(link_name):
+                raise
+            os.unlink(link_name)
+            os.symlink(entry.path, link_name)
+
+    def _link_extra_includes(self, executor, swift_module_search_path,
+                             include_dir):
+        # Each link is a few syscalls that release the GIL, so make the links
+        # for a large include dir concurrently.
+        with os.scandir(include_dir) as entries:
+            list(executor.map(
+                    lambda entry: self._link_extra_include(
+                            swift_module_search_path, entry),
+                    entries))
+
+    def _install_cache_key_parts(self, packages, swiftpm_flags, package_swift,
+                                 swift_build_path, swiftpm_env):
+        """Returns everything that a cached build depends on, or None if the
+        build must not be cached."""
+        # Only SwiftPM can tell whether local or branch-tracking packages need
+        # rebuilding.
+        if any(_RE_UNPINNED_PACKAGE.search(package['spec'])
+               for package in packages):
+            return None
+
+        # Modules built by a different compiler can't be loaded.
+        version_result = subprocess.run(
+                [swift_build_path, '--version'],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                env=swiftpm_env)
+        if version_result.returncode != 0:
+            return None
+        return [
+            os.path.realpath(swift_build_path),
+            version_result.stdout.decode('utf8'),
+            ' '.join(swiftpm_flags),
+            package_swift,
+        ]
+
+    def _read_install_cache(self, install_cache_path, install_cache_key):
+        """Returns the bin dir of a previous successful build with the same
+        key, or None if there is no such build."""
+        try:
+            with open(install_cache_path) as f:
+                install_cache = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(install_cache, dict) or \
+                install_cache.get('key') != install_cache_key:
+            return None
+        bin_dir = install_cache.get('bin_dir')
+        if not isinstance(bin_dir, str) or not os.path.isfile(
+                os.path.join(bin_dir, 'libjupyterInstalledPackages.so')):
+            return None
+        return bin_dir
+
+    def _build_package(self, swift_build_path, swiftpm_flags,
+                       package_base_path, swiftpm_env):
+        """Builds the package in `package_base_path`, streaming the build
+        output to the client, and returns the bin dir."""
+        # The bin dir only depends on the flags, so ask for it before building,
+        # so that a bad flag fails here instead of after a long build.
+        show_bin_path_result = subprocess.run(
+                [swift_build_path, '--show-bin-path'] + swiftpm_flags,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                cwd=package_base_path,
+                env=swiftpm_env)
+        if show_bin_path_result.returncode != 0:
+            raise PackageInstallException(
+                    'Install Error: swift-build --show-bin-path returned '
+                    'nonzero exit code %d.\nStderr:\n%s\n' % (
+                            show_bin_path_result.returncode,
+                            show_bin_path_result.stderr.decode('utf8')))
+        bin_dir = show_bin_path_result.stdout.decode('utf8').strip()
+
+        build_p = subprocess.Popen([swift_build_path] + swiftpm_flags,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT,
+                                   cwd=package_base_path,
+                                   env=swiftpm_env)
+        # Forward the build output in large chunks rather than line by line.
+        # After each read, keep collecting whatever else arrives within a short
+        # window, so that a burst of output results in a single stream message.
+        build_output_fd = build_p.stdout.fileno()
+        build_output_decoder = codecs.getincrementaldecoder('utf8')('replace')
+        while True:
+            build_output = os.read(build_output_fd, 65536)
+            build_output_chunks = [build_output]
+            deadline = time.monotonic() + 0.1
+            while build_output:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0 or \
+                        not select.select([build_output_fd], [], [], timeout)[0]:
+                    break
+                build_output = os.read(build_output_fd, 65536)
+                build_output_chunks.append(build_output)
+            build_output_text = build_output_decoder.decode(
+                    b''.join(build_output_chunks), final=not build_output)
+            if build_output_text:
+                self.send_response(self.iopub_socket, 'stream', {
+                    'name': 'stdout',
+                    'text': build_output_text
+                })
+            if not build_output:
+                break
+        build_returncode = build_p.wait()
+        if build_returncode != 0:
+            raise PackageInstallException(
+                    'Install Error: swift-build returned nonzero exit code '
+                    '%d.' % build_returncode)
+        return bin_dir
 
     def _install_packages(self, packages, swiftpm_flags, extra_include_commands,
                           user_install_location):
         if len(packages) == 0 and len(swiftpm_flags) == 0:
             return
 
-        if hasattr(self, 'debugger'):
+        # These are only needed for installing packages, which most kernels
+        # never do, so don't pay for importing them at startup.
+        import hashlib
+        import shutil
+        import sqlite3
+        import tempfile
+        import textwrap
+        from concurrent.futures import ThreadPoolExecutor
+
+        if self._debugger_started:
             raise PackageInstallException(
                     'Install Error: Packages can only be installed during the '
                     'first cell execution. Restart the kernel to install '
@@ -594,27 +922,39 @@ class SwiftKernel(Kernel):
         # Make the directory containing our built modules and other includes.
         os.makedirs(swift_module_search_path, exist_ok=True)
 
-        # Make links from the install location to extra includes.
-        for include_command in extra_include_commands:
-            result = subprocess.run(include_command, shell=True,
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE)
-            if result.returncode != 0:
-                raise PackageInstallException(
-                        '%%install-extra-include-command returned nonzero '
-                        'exit code: %d\nStdout:\n%s\nStderr:\n%s\n' % (
-                                result.returncode,
-                                result.stdout.decode('utf8'),
-                                result.stderr.decode('utf8')))
-            include_dirs = shlex.split(result.stdout.decode('utf8'))
-            for include_dir in include_dirs:
-                if include_dir[0:2] != '-I':
-                    self.log.warn(
-                            'Non "-I" output from '
-                            '%%install-extra-include-command: %s' % include_dir)
-                    continue
-                include_dir = include_dir[2:]
-                self._link_extra_includes(swift_module_search_path, include_dir)
+        # Make links from the install location to extra includes. The commands
+        # are independent, so run them concurrently, but link their results in
+        # order so that later include dirs still replace earlier links.
+        def run_include_command(include_command):
+            return subprocess.run(include_command, shell=True,
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE)
+
+        if extra_include_commands:
+            with ThreadPoolExecutor(max_workers=16) as executor:
+                include_results = executor.map(run_include_command,
+                                               extra_include_commands)
+                for result in include_results:
+                    if result.returncode != 0:
+                        raise PackageInstallException(
+                                '%%install-extra-include-command returned '
+                                'nonzero exit code: %d\nStdout:\n%s\n'
+                                'Stderr:\n%s\n' % (
+                                        result.returncode,
+                                        result.stdout.decode('utf8'),
+                                        result.stderr.decode('utf8')))
+                    include_dirs = shlex.split(result.stdout.decode('utf8'))
+                    for include_dir in include_dirs:
+                        if include_dir[0:2] != '-I':
+                            self.log.warn(
+                                    'Non "-I" output from '
+                                    '%%install-extra-include-command: %s' % (
+                                            include_dir))
+                            continue
+                        include_dir = include_dir[2:]
+                        self._link_extra_includes(executor,
+                                                  swift_module_search_path,
+                                                  include_dir)
 
         # Summary of how this works:
         # - create a SwiftPM package that depends on all the packages that
@@ -647,67 +987,85 @@ class SwiftKernel(Kernel):
                 ])
         """)
 
-        packages_specs = ''
-        packages_products = ''
-        packages_human_description = ''
+        packages_specs = []
+        packages_products = []
+        packages_human_description = []
         for package in packages:
-            packages_specs += '%s,\n' % package['spec']
-            packages_human_description += '\t%s\n' % package['spec']
+            packages_specs.append('%s,\n' % package['spec'])
+            packages_human_description.append('\t%s\n' % package['spec'])
             for target in package['products']:
-                packages_products += '%s,\n' % json.dumps(target)
-                packages_human_description += '\t\t%s\n' % target
+                packages_products.append('%s,\n' % _swift_str_literal(target))
+                packages_human_description.append('\t\t%s\n' % target)
+        packages_specs = ''.join(packages_specs)
+        packages_products = ''.join(packages_products)
+        packages_human_description = ''.join(packages_human_description)
 
         self.send_response(self.iopub_socket, 'stream', {
             'name': 'stdout',
-            'text': 'Installing packages:\n%s' % packages_human_description
-        })
-        self.send_response(self.iopub_socket, 'stream', {
-            'name': 'stdout',
-            'text': 'With SwiftPM flags: %s\n' % str(swiftpm_flags)
-        })
-        self.send_response(self.iopub_socket, 'stream', {
-            'name': 'stdout',
-            'text': 'Working in: %s\n' % scratchwork_base_path
+            'text': 'Installing packages:\n%s'
+                    'With SwiftPM flags: %s\n'
+                    'Working in: %s\n' % (packages_human_description,
+                                          str(swiftpm_flags),
+                                          scratchwork_base_path)
         })
 
         package_swift = package_swift_template % (packages_specs,
                                                   packages_products)
 
-        with open('%s/Package.swift' % package_base_path, 'w') as f:
+        with open(os.path.join(package_base_path, 'Package.swift'), 'w') as f:
             f.write(package_swift)
-        with open('%s/jupyterInstalledPackages.swift' % package_base_path, 'w') as f:
+        with open(os.path.join(package_base_path,
+                               'jupyterInstalledPackages.swift'), 'w') as f:
             f.write("// intentionally blank\n")
 
         # == Ask SwiftPM to build the package ==
 
         # TODO(TF-1179): Remove this workaround after fixing SwiftPM.
-        swiftpm_env = os.environ
+        swiftpm_env = dict(os.environ)
         libuuid_path = '/lib/x86_64-linux-gnu/libuuid.so.1'
         if os.path.isfile(libuuid_path):
             swiftpm_env['LD_PRELOAD'] = libuuid_path
 
-        build_p = subprocess.Popen([swift_build_path] + swiftpm_flags,
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT,
-                                   cwd=package_base_path,
-                                   env=swiftpm_env)
-        for build_output_line in iter(build_p.stdout.readline, b''):
+        # A custom install location survives kernel restarts. If the last build
+        # there was for the same pinned packages, flags and toolchain and it
+        # succeeded, reuse it instead of running swift-build, which resolves
+        # the whole package graph even when there is nothing to rebuild. The
+        # default location is a new temporary directory, so there is never
+        # anything to reuse there.
+        install_cache_path = os.path.join(scratchwork_base_path,
+                                          'install-cache.json')
+        install_cache_key = None
+        bin_dir = None
+        if user_install_location is not None:
+            install_cache_key_parts = self._install_cache_key_parts(
+                    packages, swiftpm_flags, package_swift, swift_build_path,
+                    swiftpm_env)
+            if install_cache_key_parts is not None:
+                install_cache_key = hashlib.sha256(
+                        '\n'.join(install_cache_key_parts).encode('utf8')
+                        ).hexdigest()
+                bin_dir = self._read_install_cache(install_cache_path,
+                                                   install_cache_key)
+
+        if bin_dir is not None:
             self.send_response(self.iopub_socket, 'stream', {
                 'name': 'stdout',
-                'text': build_output_line.decode('utf8')
+                'text': 'Packages are already built, skipping swift-build.\n'
             })
-        build_returncode = build_p.wait()
-        if build_returncode != 0:
-            raise PackageInstallException(
-                    'Install Error: swift-build returned nonzero exit code '
-                    '%d.' % build_returncode)
-
-        show_bin_path_result = subprocess.run(
-                [swift_build_path, '--show-bin-path'] + swiftpm_flags,
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                cwd=package_base_path,
-                env=swiftpm_env)
-        bin_dir = show_bin_path_result.stdout.decode('utf8').strip()
+        else:
+            # A failed build may leave a half-updated bin dir behind, so
+            # forget the previous build before starting.
+            if user_install_location is not None:
+                try:
+                    os.unlink(install_cache_path)
+                except FileNotFoundError:
+                    pass
+            bin_dir = self._build_package(swift_build_path, swiftpm_flags,
+                                          package_base_path, swiftpm_env)
+            if install_cache_key is not None:
+                with open(install_cache_path, 'w') as f:
+                    json.dump({'key': install_cache_key, 'bin_dir': bin_dir},
+                              f)
         lib_filename = os.path.join(bin_dir, 'libjupyterInstalledPackages.so')
 
         # == Copy .swiftmodule and modulemap files to SWIFT_IMPORT_SEARCH_PATH ==
@@ -730,69 +1088,145 @@ class SwiftKernel(Kernel):
         dependencies_json = dependencies_result.stdout.decode('utf8')
         dependencies_obj = json.loads(dependencies_json)
 
-        def flatten_deps_paths(dep):
-            paths = []
-            paths.append(dep["path"])
-            if dep["dependencies"]:
-                for d in dep["dependencies"]:
-                    paths.extend(flatten_deps_paths(d))
+        def flatten_deps_paths(root):
+            # Iterative DFS, so that deep dependency graphs don't hit the
+            # recursion limit and shared dependencies are only visited once.
+            paths = set()
+            stack = [root]
+            while stack:
+                dep = stack.pop()
+                if dep["path"] in paths:
+                    continue
+                paths.add(dep["path"])
+                stack.extend(dep.get("dependencies") or ())
             return paths
 
-        # Make list of paths where we expect .swiftmodule and .modulemap files of dependencies
-        dependencies_paths = [package_base_path]
+        # Make set of paths where we expect .swiftmodule and .modulemap files of dependencies
         dependencies_paths = flatten_deps_paths(dependencies_obj)
-        dependencies_paths = list(set(dependencies_paths))
+
+        # Sorted dependency paths, without paths that are covered by a shorter
+        # path. In such a list, the only candidate prefix of a path is the
+        # closest entry that sorts before it, so lookups can use bisect.
+        dependencies_prefixes = []
+        for p in sorted(dependencies_paths):
+            if not dependencies_prefixes or \
+                    not p.startswith(dependencies_prefixes[-1]):
+                dependencies_prefixes.append(p)
 
         def is_valid_dependency(path):
-            for p in dependencies_paths:
-                if path.startswith(p): return True
-            return False
+            i = bisect.bisect_right(dependencies_prefixes, path) - 1
+            return i >= 0 and path.startswith(dependencies_prefixes[i])
 
         # Query to get build files list from build.db
         # SUBSTR because string starts with "N" (why?)
-        SQL_FILES_SELECT = "SELECT SUBSTR(key, 2) FROM 'key_names' WHERE key LIKE ?"
+        # Rows that don't belong to a dependency are filtered out inside SQLite,
+        # so that they never get materialized as Python tuples. One scan of the
+        # table finds both kinds of files, and the second column tells them
+        # apart.
+        SQL_FILES_SELECT = "SELECT SUBSTR(key, 2), key LIKE '%.swiftmodule' " \
+                           "FROM 'key_names' " \
+                           "WHERE (key LIKE '%.swiftmodule' OR " \
+                           "       key LIKE '%/module.modulemap') " \
+                           "AND is_valid_dependency(SUBSTR(key, 2))"
 
         # Connect to build.db
         db_connection = sqlite3.connect(build_db_file)
-        cursor = db_connection.cursor()
-
-        # Process *.swiftmodules files
-        cursor.execute(SQL_FILES_SELECT, ['%.swiftmodule'])
-        swift_modules = [row[0] for row in cursor.fetchall() if is_valid_dependency(row[0])]
-        for filename in swift_modules:
-            shutil.copy(filename, swift_module_search_path)
-
-        # Process modulemap files
-        cursor.execute(SQL_FILES_SELECT, ['%/module.modulemap'])
-        modulemap_files = [row[0] for row in cursor.fetchall() if is_valid_dependency(row[0])]
-        for index, filename in enumerate(modulemap_files):
-            # Create a separate directory for each modulemap file because the
-            # ClangImporter requires that they are all named
-            # "module.modulemap".
-            # Use the module name to prevent two modulema[s for the same
-            # depndency ending up in multiple directories after several
-            # installations, causing the kernel to end up in a bad state.
-            # Make all relative header paths in module.modulemap absolute
-            # because we copy file to different location.
-
-            src_folder, src_filename = os.path.split(filename)
-            with open(filename, encoding='utf8') as file:
-                modulemap_contents = file.read()
-                modulemap_contents = re.sub(
-                    r'header\s+"(.*?)"',
-                    lambda m: 'header "%s"' %
-                        (m.group(1) if os.path.isabs(m.group(1)) else os.path.abspath(os.path.join(src_folder, m.group(1)))),
+        try:
+            # build.db can be large, and the LIKE filters cannot use an index,
+            # so the query scans the whole table. Let SQLite map the file
+            # instead of read()ing it page by page. Filesystems that can't be
+            # mapped fall back to reads. This connection only reads, so leave
+            # the database's journal mode alone.
+            db_connection.execute('PRAGMA mmap_size = %d' % (1 << 28))
+            db_connection.execute('PRAGMA query_only = ON')
+            db_connection.create_function('is_valid_dependency', 1,
+                                          is_valid_dependency)
+            swift_modules = []
+            modulemap_files = []
+            for filename, is_swift_module in db_connection.execute(
+                    SQL_FILES_SELECT):
+                if is_swift_module:
+                    swift_modules.append(filename)
+                else:
+                    modulemap_files.append(filename)
+        finally:
+            db_connection.close()
+
+        # Copying modules and rewriting modulemaps is independent per file and
+        # mostly waits on the disk, so overlap the files in a thread pool.
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            # Process *.swiftmodules files
+            # Several modules can share a name, e.g. debug and release builds
+            # of the same dependency. Copying them concurrently to the same
+            # destination could interleave their writes, so pick the module
+            # that a serial copy would have left behind (the last one in
+            # build.db order) for each destination first.
+            swift_module_copies = {
+                    os.path.join(swift_module_search_path,
+                                 os.path.basename(filename)): filename
+                    for filename in swift_modules}
+            # `copyfile` to an explicit destination skips the isdir check and
+            # the chmod that `copy` does, and still uses the kernel's
+            # zero-copy path where available.
+            list(executor.map(
+                    lambda copy: shutil.copyfile(copy[1], copy[0]),
+                    swift_module_copies.items()))
+
+            # Process modulemap files
+            isabs = os.path.isabs
+            normpath = os.path.normpath
+            join = os.path.join
+
+            # `src_folder` must be absolute, so that resolving each header does
+            # not need `abspath`, which calls `getcwd` for relative paths.
+            def absolute_header(src_folder, header):
+                return 'header "%s"' % (
+                        header if isabs(header)
+                        else normpath(join(src_folder, header)))
+
+            def rewrite_modulemap(index, filename):
+                # Create a separate directory for each modulemap file because
+                # the ClangImporter requires that they are all named
+                # "module.modulemap".
+                # Use the module name to prevent two modulema[s for the same
+                # depndency ending up in multiple directories after several
+                # installations, causing the kernel to end up in a bad state.
+                # Make all relative header paths in module.modulemap absolute
+                # because we copy file to different location.
+
+                src_folder, src_filename = os.path.split(filename)
+                src_folder = os.path.abspath(src_folder)
+                with open(filename, encoding='utf8') as file:
+                    modulemap_contents = file.read()
+                modulemap_contents = _RE_MODULEMAP_HEADER.sub(
+                    lambda m: absolute_header(src_folder, m.group(1)),
                     modulemap_contents
                 )
 
-                module_match = re.match(r'module\s+([^\s]+)\s.*{', modulemap_contents)
+                module_match = _RE_MODULEMAP_MODULE.match(modulemap_contents)
                 module_name = module_match.group(1) if module_match is not None else str(index)
                 modulemap_dest = os.path.join(swift_module_search_path, 'modulemap-%s' % module_name)
-                os.makedirs(modulemap_dest, exist_ok=True)
                 dst_path = os.path.join(modulemap_dest, src_filename)
-
-                with open(dst_path, 'w', encoding='utf8') as outfile:
-                    outfile.write(modulemap_contents)
+                return dst_path, modulemap_contents
+
+            modulemaps = list(executor.map(
+                    rewrite_modulemap, range(len(modulemap_files)),
+                    modulemap_files))
+
+        # Write the modulemaps in build.db order, so that when two modulemaps
+        # declare the same module, the result does not depend on scheduling.
+        # Modulemaps are small, so write them with plain os.write calls rather
+        # than through buffered file objects.
+        for modulemap_dest in {os.path.dirname(p) for p, _ in modulemaps}:
+            os.makedirs(modulemap_dest, exist_ok=True)
+        for dst_path, modulemap_contents in modulemaps:
+            data = memoryview(modulemap_contents.encode('utf8'))
+            fd = os.open(dst_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                while data:
+                    data = data[os.write(fd, data):]
+            finally:
+                os.close(fd)
 
         # == dlopen the shared lib ==
 
@@ -802,12 +1236,8 @@ class SwiftKernel(Kernel):
         })
         self._init_swift()
 
-        dynamic_load_code = textwrap.dedent("""\
-            import func Glibc.dlopen
-            import var Glibc.RTLD_NOW
-            dlopen(%s, RTLD_NOW)
-        """ % json.dumps(lib_filename))
-        dynamic_load_result = self._execute(dynamic_load_code)
+        dynamic_load_code = _DLOPEN_TEMPLATE % _swift_str_literal(lib_filename)
+        dynamic_load_result = self._execute_internal(dynamic_load_code)
         if not isinstance(dynamic_load_result, SuccessWithValue):
             raise PackageInstallException(
                     'Install Error: dlopen error: %s' % \
@@ -824,21 +1254,46 @@ class SwiftKernel(Kernel):
         self.already_installed_packages = True
 
     def _execute(self, code):
-        locationDirective = '#sourceLocation(file: "%s", line: 1)' % (
-            self._file_name_for_source_location())
-        codeWithLocationDirective = locationDirective + '\n' + code
-        result = self.target.EvaluateExpression(
-                codeWithLocationDirective, self.expr_opts)
+        # Evaluating an expression means compiling and injecting it into the
+        # process, which isn't worth doing when there is nothing to run. This
+        # happens e.g. when a cell only contains "%install" directives.
+        if _RE_BLANK_CODE.match(code):
+            return _SUCCESS_WITHOUT_VALUE
+
+        return self._execute_internal(self._location_directive + code)
+
+    def _execute_internal(self, code):
+        """Executes code that the kernel generates. Unlike `_execute`, this
+        does not attribute the code to the current cell, because errors in it
+        are not the user's, and such code is usually much shorter than the
+        directive."""
+        result = self.target.EvaluateExpression(code, self.expr_opts)
 
         if result.error.type == lldb.eErrorTypeInvalid:
             return SuccessWithValue(result)
         elif result.error.type == lldb.eErrorTypeGeneric:
-            return SuccessWithoutValue()
+            return _SUCCESS_WITHOUT_VALUE
         else:
             return SwiftError(result)
 
+    def _has_after_successful_execution_handlers(self):
+        # Reading the flag directly from memory is much cheaper than evaluating
+        # an expression, which has to be compiled and injected into the process.
+        error = lldb.SBError()
+        has_handlers = self.process.ReadUnsignedFromMemory(
+                self._has_handlers_address, 1, error)
+        if error.Fail():
+            raise Exception('reading hasAfterSuccessfulExecutionHandlers: %s' %
+                            str(error))
+        return has_handlers != 0
+
     def _after_successful_execution(self):
-        result = self._execute(
+        # Most notebooks never register a handler (e.g. by including
+        # "EnableIPythonDisplay.swift"), so usually there is nothing to do.
+        if not self._has_after_successful_execution_handlers():
+            return
+
+        result = self._execute_internal(
                 'JupyterKernel.communicator.triggerAfterSuccessfulExecution()')
         if not isinstance(result, SuccessWithValue):
             self.log.error(
@@ -850,17 +1305,34 @@ class SwiftKernel(Kernel):
         self._send_jupyter_messages(messages)
 
     def _read_jupyter_messages(self, sbvalue):
+        """Reads the messages returned by `triggerAfterSuccessfulExecution`.
+
+        The messages are serialized into a single buffer (see the doc comment
+        in KernelCommunicator.swift), so this takes one memory read no matter
+        how many messages and parts there are."""
+        data = self._read_byte_array(sbvalue)
+        # Parts are slices of this view rather than copies of the bytes.
+        data_view = memoryview(data)
+        unpack_from = _UINT32.unpack_from
+        uint32_size = _UINT32.size
+
+        message_count, = unpack_from(data, 0)
+        offset = uint32_size
+        display_messages = [None] * message_count
+        for i in range(message_count):
+            part_count, = unpack_from(data, offset)
+            offset += uint32_size
+            display_message = [None] * part_count
+            for j in range(part_count):
+                count, = unpack_from(data, offset)
+                offset += uint32_size
+                display_message[j] = data_view[offset:offset + count]
+                offset += count
+            display_messages[i] = display_message
         return {
-            'display_messages': [
-                self._read_display_message(display_message_sbvalue)
-                for display_message_sbvalue
-                in sbvalue
-            ]
+            'display_messages': display_messages
         }
 
-    def _read_display_message(self, sbvalue):
-        return [self._read_byte_array(part) for part in sbvalue]
-
     def _read_byte_array(self, sbvalue):
         get_address_error = lldb.SBError()
         address = sbvalue \
@@ -874,13 +1346,7 @@ class SwiftKernel(Kernel):
         count_data = sbvalue \
                 .GetChildMemberWithName('count') \
                 .GetData()
-        if self._int_bitwidth == 32:
-            count = count_data.GetSignedInt32(get_count_error, 0)
-        elif self._int_bitwidth == 64:
-            count = count_data.GetSignedInt64(get_count_error, 0)
-        else:
-            raise Exception('Unsupported integer bitwidth %d' %
-                            self._int_bitwidth)
+        count = self._read_int(count_data, get_count_error, 0)
         if get_count_error.Fail():
             raise Exception('getting count: %s' % str(get_count_error))
 
@@ -897,14 +1363,18 @@ class SwiftKernel(Kernel):
         return data
 
     def _send_jupyter_messages(self, messages):
+        # The message parts are never modified after this, so zmq can send
+        # them without copying.
         for display_message in messages['display_messages']:
-            self.iopub_socket.send_multipart(display_message)
+            self.iopub_socket.send_multipart(display_message, copy=False,
+                                             track=False)
 
     def _set_parent_message(self):
-        result = self._execute("""
-            JupyterKernel.communicator.updateParentMessage(
-                to: KernelCommunicator.ParentMessage(json: %s))
-        """ % json.dumps(json.dumps(squash_dates(self._parent_header))))
+        # Quote the JSON directly rather than encoding the whole header a
+        # second time.
+        parent_json = json.dumps(squash_dates(self._parent_header))
+        result = self._execute_internal(_SET_PARENT_MESSAGE_TEMPLATE % (
+                _swift_str_literal(parent_json)))
         if isinstance(result, ExecutionResultError):
             raise Exception('Error setting parent message: %s' % result)
 
@@ -914,15 +1384,31 @@ class SwiftKernel(Kernel):
             # Do not include frames without source location information. These
             # are frames in libraries and frames that belong to the LLDB
             # expression execution implementation.
-            if not frame.line_entry.file:
+            line_entry = frame.GetLineEntry()
+            if not line_entry.IsValid():
+                continue
+            file_name = line_entry.GetFileSpec().GetFilename()
+            if not file_name:
                 continue
             # Do not include <compiler-generated> frames. These are
             # specializations of library functions.
-            if frame.line_entry.file.fullpath == '<compiler-generated>':
+            if file_name == '<compiler-generated>':
                 continue
-            stack_trace.append(str(frame))
+            # Format the frame ourselves, because LLDB's default frame
+            # formatting (`str(frame)`) is slow.
+            stack_trace.append('frame #%d: %s at %s:%d:%d' % (
+                frame.GetFrameID(), frame.GetFunctionName(), file_name,
+                line_entry.GetLine(), line_entry.GetColumn()))
         return stack_trace
 
+    def _make_execute_reply_ok_message(self):
+        return {
+            'status': 'ok',
+            'execution_count': self.execution_count,
+            'payload': [],
+            'user_expressions': {},
+        }
+
     def _make_execute_reply_error_message(self, traceback):
         return {
             'status': 'error',
@@ -956,16 +1442,16 @@ class SwiftKernel(Kernel):
 
     def do_execute(self, code, silent, store_history=True,
                    user_expressions=None, allow_stdin=False):
-
         # Return early if the code is empty or whitespace, to avoid
-        # initializing Swift and preventing package installs.
+        # initializing Swift and preventing package installs. `isspace` stops
+        # at the first non-whitespace character, so this is cheap for real
+        # code.
         if len(code) == 0 or code.isspace():
-            return {
-                'status': 'ok',
-                'execution_count': self.execution_count,
-                'payload': [],
-                'user_expressions': {}
-            }
+            return self._make_execute_reply_ok_message()
+
+        self._update_cell_file_name()
+        self._cwd = os.getcwd()
+        self._cwd_subst = {'cwd': self._cwd}
 
         # Package installs must be done before initializing Swift (see doc
         # comment in `_init_swift`).
@@ -978,23 +1464,21 @@ class SwiftKernel(Kernel):
             self._send_exception_report('_process_installs', e)
             raise e
 
-        if not hasattr(self, 'debugger'):
+        if not self._debugger_started:
             self._init_swift()
 
-        # Start up a new thread to collect stdout.
-        stdout_handler = StdoutHandler(self)
-        stdout_handler.start()
+        # Start collecting stdout.
+        self.stdout_handler.start_cell()
 
         # Execute the cell, handle unexpected exceptions, and make sure to
-        # always clean up the stdout handler.
+        # always stop collecting stdout.
         try:
             result = self._execute_cell(code)
         except Exception as e:
             self._send_exception_report('_execute_cell', e)
             raise e
         finally:
-            stdout_handler.stop_event.set()
-            stdout_handler.join()
+            self.stdout_handler.stop_cell()
 
         # Send values/errors and status to the client.
         if isinstance(result, SuccessWithValue):
@@ -1006,19 +1490,9 @@ class SwiftKernel(Kernel):
                 },
                 'metadata': {}
             })
-            return {
-                'status': 'ok',
-                'execution_count': self.execution_count,
-                'payload': [],
-                'user_expressions': {}
-            }
+            return self._make_execute_reply_ok_message()
         elif isinstance(result, SuccessWithoutValue):
-            return {
-                'status': 'ok',
-                'execution_count': self.execution_count,
-                'payload': [],
-                'user_expressions': {}
-            }
+            return self._make_execute_reply_ok_message()
         elif isinstance(result, ExecutionResultError):
             if not self.process.is_alive:
                 self._send_iopub_error_message(['Process killed'])
@@ -1033,7 +1507,7 @@ class SwiftKernel(Kernel):
 
                 return self._make_execute_reply_error_message(['Process killed'])
 
-            if stdout_handler.had_stdout:
+            if self.stdout_handler.had_stdout:
                 # When there is stdout, it is a runtime error. Stdout, which we
                 # have already sent to the client, contains the error message
                 # (plus some other ugly traceback that we should eventually
@@ -1067,13 +1541,22 @@ class SwiftKernel(Kernel):
         sbresponse = self.target.CompleteCode(
             self.swift_language, None, code_to_cursor)
         prefix = sbresponse.GetPrefix()
-        insertable_matches = []
-        for i in range(sbresponse.GetNumMatches()):
-            sbmatch = sbresponse.GetMatchAtIndex(i)
-            insertable_match = prefix + sbmatch.GetInsertable()
-            if insertable_match.startswith("_"):
-                continue
-            insertable_matches.append(insertable_match)
+        get_match = sbresponse.GetMatchAtIndex
+        match_indices = range(sbresponse.GetNumMatches())
+        # Matches that start with "_" are hidden. A nonempty prefix starts
+        # every match, so it decides for all of them at once.
+        if prefix.startswith("_"):
+            insertable_matches = []
+        elif prefix:
+            insertable_matches = [
+                prefix + get_match(i).GetInsertable() for i in match_indices]
+        else:
+            insertable_matches = [
+                insertable_match
+                for insertable_match in (
+                    get_match(i).GetInsertable() for i in match_indices)
+                if not insertable_match.startswith("_")
+            ]
         return {
             'status': 'ok',
             'matches': insertable_matches,
@@ -5,9 +5,15 @@ import unittest
 import jupyter_kernel_test
 import time
 import os
+import shutil
+import subprocess
+import tempfile
 
 from jupyter_client.manager import start_new_kernel
 
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+NOTEBOOK_DIR = os.path.join(THIS_DIR, 'notebooks')
+
 class SwiftKernelTests(jupyter_kernel_test.KernelTests):
     language_name = 'swift'
     kernel_name = 'swift'
@@ -282,6 +288,24 @@ class SwiftKernelTests(jupyter_kernel_test.KernelTests):
                     "Use `print()` to show values",
                     output_msgs[0]['content']['data']['text/plain'])
 
+    def test_comment_banner(self):
+        # Cells are checked for being blank before they are executed. That
+        # check must not take exponential time on lines full of slashes.
+        reply, output_msgs = self.execute_helper(code="""
+            %s
+            // %s
+            print("after banner")
+        """ % ('/' * 80, '// ' * 20))
+        self.assertEqual(reply['content']['status'], 'ok')
+        self.assertEqual('after banner\n', output_msgs[0]['content']['text'])
+
+        reply, output_msgs = self.execute_helper(code="""
+            %s
+            // only comments
+        """ % ('/' * 80))
+        self.assertEqual(reply['content']['status'], 'ok')
+        self.assertEqual([], output_msgs)
+
 
 # Class for tests that need their own kernel. (`SwiftKernelTestsBase` uses one
 # kernel for all the tests.)
@@ -346,6 +370,56 @@ class OwnKernelTests(unittest.TestCase):
                 stdout += message['content']['text']
         self.assertIn('Installing packages:', stdout)
 
+    def test_install_cache(self):
+        # Installing the same pinned packages into the same
+        # "%install-location" again reuses the earlier build, and still copies
+        # its modules so that they can be imported.
+        work_dir = tempfile.mkdtemp()
+        package_dir = os.path.join(work_dir, 'SimplePackage')
+        shutil.copytree(os.path.join(NOTEBOOK_DIR, 'SimplePackage'),
+                        package_dir)
+        for git_args in [['init'], ['add', '.'],
+                         ['commit', '-m', 'SimplePackage'], ['tag', '1.0.0']]:
+            subprocess.check_call(
+                    ['git', '-c', 'user.name=test',
+                     '-c', 'user.email=test@example.com'] + git_args,
+                    cwd=package_dir, stdout=subprocess.DEVNULL)
+        install_code = """
+            %%install-location %s
+            %%install '.package(url: "file://%s", .exact("1.0.0"))' SimplePackage
+        """ % (os.path.join(work_dir, 'install'), package_dir)
+
+        try:
+            for run in range(2):
+                km, kc = start_new_kernel(kernel_name='swift')
+                kc.execute(install_code)
+                install_stdout = self.get_stdout(self.wait_for_idle(kc))
+                kc.execute("""
+                    import SimplePackage
+                    print(publicIntThatIsInSimplePackage)
+                """)
+                stdout = self.get_stdout(self.wait_for_idle(kc))
+                km.shutdown_kernel()
+
+                self.assertIn('Installation complete', install_stdout)
+                if run == 0:
+                    self.assertNotIn('Packages are already built',
+                                     install_stdout)
+                else:
+                    self.assertIn('Packages are already built',
+                                  install_stdout)
+                self.assertIn('42', stdout)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def get_stdout(self, messages):
+        stdout = ''
+        for message in messages:
+            if message['header']['msg_type'] == 'stream' and \
+                    message['content']['name'] == 'stdout':
+                stdout += message['content']['text']
+        return stdout
+
     def wait_for_idle(self, kc):
         messages = []
         while True:
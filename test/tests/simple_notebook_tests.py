@@ -3,6 +3,7 @@
 
 import unittest
 import os
+import shutil
 
 from notebook_tester import ExecuteError
 from notebook_tester import NotebookTestRunner
@@ -52,3 +53,22 @@ class SimpleNotebookTests(unittest.TestCase):
         self.assertIn('Installation complete', runner.stdout[0])
         self.assertIn('42', runner.stdout[2])
         self.assertIn('1337', runner.stdout[3])
+
+    def test_install_package_with_user_location(self):
+        # The install location keeps earlier builds, but local packages can
+        # change without their spec changing, so they are always rebuilt.
+        notebook = os.path.join(NOTEBOOK_DIR,
+                                'install_package_with_user_location.ipynb')
+        install_location = os.path.join(NOTEBOOK_DIR, 'swift-modules')
+        shutil.rmtree(install_location, ignore_errors=True)
+        try:
+            for _ in range(2):
+                runner = NotebookTestRunner(notebook, char_step=0,
+                                            verbose=False)
+                runner.run()
+                self.assertIn('Installation complete', runner.stdout[0])
+                self.assertNotIn('Packages are already built',
+                                 runner.stdout[0])
+                self.assertIn('42', runner.stdout[2])
+        finally:
+            shutil.rmtree(install_location, ignore_errors=True)